@@ -1,12 +1,68 @@
 #! /usr/bin/env python
 
+import math
 import numpy as np
-from scipy.stats import norm, uniform
 import logging
 from .base import BaseSimulator
 
+try:
+    from numba import njit, prange
+except ImportError:
+    njit, prange = None, None
+
 logger = logging.getLogger(__name__)
 
+_NORM = 1.0 / math.sqrt(2.0 * math.pi)  # Python float, so it does not upcast float32 arrays
+
+
+def _rng():
+    """ Fast PCG64 generator, seeded from the global numpy state so that np.random.seed() keeps results reproducible """
+    return np.random.default_rng(np.random.randint(2 ** 31))
+
+
+_z_to_x_kernel = None
+_mixture_logpdf_kernel = None
+if njit is not None:
+
+    @njit(parallel=True, fastmath=True)
+    def _z_to_x_kernel(z_phi, r, out):
+        """ Fused spherical -> Cartesian transform, writes the first latent_dim + 1 columns of out """
+        n, latent_dim = z_phi.shape
+        for i in prange(n):
+            s = r[i]
+            for k in range(latent_dim):
+                out[i, k] = s * math.cos(z_phi[i, k])
+                s *= math.sin(z_phi[i, k])
+            out[i, latent_dim] = s
+
+    @njit(parallel=True, fastmath=True)
+    def _mixture_logpdf_kernel(z_phi, phases, widths, out):
+        """ Same as summing the Gaussian over _generate_equivalent_coordinates, but the variants are built on the fly per entry """
+        n, latent_dim = z_phi.shape
+        n_unshifted = 2 * (latent_dim - 1) + 1  # Number of variants in which a given coordinate keeps its canonical value
+        two_pi = 2.0 * math.pi
+        row_stride = 1 if phases.shape[0] > 1 else 0  # Phases and widths may be a single broadcast row
+        for i in prange(n):
+            j = i * row_stride
+            for k in range(latent_dim):
+                inv_w = 1.0 / widths[j, k]
+                mu = phases[j, k]
+
+                # Canonical range: [0, pi) for polar angles, and [0., 2pi) for azimuthal angle, and the two shifted variants
+                z = z_phi[i, k] % two_pi
+                if k < latent_dim - 1:
+                    if z > math.pi:
+                        z = two_pi - z
+                    z_low, z_high = -z, two_pi - z
+                else:
+                    z_low, z_high = z - two_pi, z + two_pi
+
+                d = (z - mu) * inv_w
+                d_low = (z_low - mu) * inv_w
+                d_high = (z_high - mu) * inv_w
+                p = n_unshifted * math.exp(-0.5 * d * d) + math.exp(-0.5 * d_low * d_low) + math.exp(-0.5 * d_high * d_high)
+                out[i, k] = math.log(p * inv_w * _NORM)
+
 
 class ConditionalSphericalGaussianSimulator(BaseSimulator):
     def __init__(self, latent_dim=8, data_dim=9, min_width=0.1 * np.pi, max_width=0.4 * np.pi, epsilon=0.01):
@@ -20,6 +76,13 @@ class ConditionalSphericalGaussianSimulator(BaseSimulator):
         self._maxwidth = max_width
         self._epsilon = epsilon
 
+        # Constants used in every density evaluation
+        self._exponents = np.arange(latent_dim - 1, 0, -1, dtype=np.float32)  # Jacobian exponents of the polar angles, the azimuthal one is zero
+        self._two_pi = 2.0 * math.pi
+        self._log_sqrt_2pi = 0.5 * math.log(2.0 * math.pi)
+        self._inv_eps = 1.0 / float(epsilon)
+        self._log_eps_norm = -math.log(epsilon) - self._log_sqrt_2pi
+
         assert data_dim > latent_dim
         assert epsilon > 0.0
         assert 0.0 < min_width < max_width <= 2.0 * np.pi
@@ -39,6 +102,8 @@ class ConditionalSphericalGaussianSimulator(BaseSimulator):
     def log_density(self, x, parameters=None, precise=False):
         assert parameters is not None
 
+        # Densities are ground truth for the evaluation, so always double precision (only sampling runs in single precision)
+        x = np.asarray(x, dtype=np.float64)
         z_phi, z_eps = self._transform_x_to_z(x)
         logp = self._log_density(z_phi, z_eps, parameters=parameters, precise=precise)
 
@@ -57,21 +122,26 @@ class ConditionalSphericalGaussianSimulator(BaseSimulator):
         return np.sum(z_eps ** 2, axis=1) ** 0.5
 
     def sample_from_prior(self, n):
-        return uniform.rvs(loc=-1.0, scale=2.0, size=(n, self.parameter_dim()))
+        return _rng().uniform(-1.0, 1.0, size=(n, self.parameter_dim()))
 
     def evaluate_log_prior(self, parameters):
         parameters = parameters.reshape((-1, self.parameter_dim()))
-        return np.sum(uniform.logpdf(parameters, loc=-1.0, scale=2.0), axis=1)
+        in_support = np.all((parameters >= -1.0) & (parameters <= 1.0), axis=1)
+        return np.where(in_support, -self.parameter_dim() * math.log(2.0), -np.inf)
 
-    def _parse_parameters(self, n, parameters):
+    def _parse_parameters(self, n, parameters, dtype=np.float32):
         parameters = parameters.reshape(-1, 2)
-        widths_ = np.empty((self._latent_dim, n))
-        phases_ = np.empty((self._latent_dim, n))
-        widths_[:] = self._minwidth + (0.5 + 0.5 * parameters[:, 0]) * (self._maxwidth - self._minwidth)
-        phases_[:-1, :] = 0.5 * np.pi
-        phases_[-1, :] = self._minphase + (0.5 + 0.5 * parameters[:, 1]) * (self._maxphase - self._minphase)
-        widths_ = widths_.T
-        phases_ = phases_.T
+        assert parameters.shape[0] in (1, n)
+        if len(parameters) > 0 and np.all(parameters == parameters[0]):
+            # Same parameters for every sample: keep a single row and let numpy broadcast it downstream
+            parameters = parameters[:1]
+            n = 1
+
+        widths_ = np.empty((n, self._latent_dim), dtype=dtype)
+        phases_ = np.empty((n, self._latent_dim), dtype=dtype)
+        widths_[:] = (self._minwidth + (0.5 + 0.5 * parameters[:, 0]) * (self._maxwidth - self._minwidth))[:, np.newaxis]
+        phases_[:, :-1] = 0.5 * np.pi
+        phases_[:, -1] = self._minphase + (0.5 + 0.5 * parameters[:, 1]) * (self._maxphase - self._minphase)
 
         return phases_, widths_
 
@@ -79,81 +149,84 @@ class ConditionalSphericalGaussianSimulator(BaseSimulator):
         # Parameters
         phases_, widths_ = self._parse_parameters(n, parameters)
 
+        rng = _rng()
+
         # Spherical coordinates
-        z_phi = np.random.normal(phases_.flatten(), widths_.flatten(), size=(n * self._latent_dim)).reshape((n, self._latent_dim))
-        z_phi = np.mod(z_phi, 2.0 * np.pi)
+        z_phi = rng.standard_normal((n, self._latent_dim), dtype=np.float32) * widths_ + phases_  # Not wrapped to [0, 2pi), the transformation is periodic anyway
 
         # Fuzzy coordinates
-        z_eps = np.random.normal(0.0, self._epsilon, size=(n * (self._data_dim - self._latent_dim))).reshape((n, self._data_dim - self._latent_dim))
+        z_eps = self._epsilon * rng.standard_normal((n, self._data_dim - self._latent_dim), dtype=np.float32)
         return z_phi, z_eps
 
     def _transform_z_to_x(self, z_phi, z_eps):
         r = 1.0 + z_eps[:, 0]
-        a = np.concatenate((2 * np.pi * np.ones((z_phi.shape[0], 1)), z_phi), axis=1)  # n entries, each (2 pi, z_sub)
-        sins = np.sin(a)
-        sins[:, 0] = 1
-        sins = np.cumprod(sins, axis=1)  # n entries, each (1, sin(z0), sin(z1), ..., sin(zk))
-        coss = np.cos(a)
-        coss = np.roll(coss, -1)  # n entries, each (cos(z0), cos(z1), ..., cos(zk), 1)
-        exact_sphere = sins * coss  # (n, k+1)
-        fuzzy_sphere = exact_sphere * r[:, np.newaxis]
-        x = np.concatenate((fuzzy_sphere, z_eps[:, 1:]), axis=1)
+        x = np.empty((z_phi.shape[0], self._data_dim), dtype=z_phi.dtype)
+        if _z_to_x_kernel is not None:
+            _z_to_x_kernel(z_phi, r, x)
+        else:
+            sins = np.cumprod(np.sin(z_phi), axis=1) * r[:, np.newaxis]  # n entries, each r * (sin(z0), sin(z0) sin(z1), ..., sin(z0)...sin(zk))
+            x[:, 0] = r * np.cos(z_phi[:, 0])
+            x[:, 1 : self._latent_dim] = sins[:, :-1] * np.cos(z_phi[:, 1:])
+            x[:, self._latent_dim] = sins[:, -1]
+        x[:, self._latent_dim + 1 :] = z_eps[:, 1:]
         return x
 
     def _transform_x_to_z(self, x):
-        z_phi = np.zeros((x.shape[0], self._latent_dim))
-        for i in range(self._latent_dim):
-            z_phi[:, i] = np.arccos(x[:, i] / np.sum(x[:, i : self._latent_dim + 1] ** 2, axis=1) ** 0.5)
+        r2 = np.cumsum(x[:, self._latent_dim :: -1] ** 2, axis=1)[:, ::-1]  # r2[:, i] = sum_{j >= i} x_j^2
+        z_phi = np.arctan2(r2[:, 1:] ** 0.5, x[:, : self._latent_dim])  # Same as arccos(x_i / r_i), but stable near the poles in single precision
         # Special case for last component, see https://en.wikipedia.org/wiki/N-sphere#Spherical_coordinates
         z_phi[:, self._latent_dim - 1] = np.where(x[:, self._latent_dim] < 0.0, 2.0 * np.pi - z_phi[:, self._latent_dim - 1], z_phi[:, self._latent_dim - 1])
 
-        r = np.sum(x[:, : self._latent_dim + 1] ** 2, axis=1) ** 0.5
+        r = r2[:, 0] ** 0.5
         z_eps = np.copy(x[:, self._latent_dim :])
         z_eps[:, 0] = r - 1
         return z_phi, z_eps
 
     def _log_density(self, z_phi, z_eps, parameters, precise=False):
         r = 1.0 + z_eps[:, 0]
-        phases_, widths_ = self._parse_parameters(z_phi.shape[0], parameters)
-
-        p_sub = 0.0
-        for shifted_z_phi in self._generate_equivalent_coordinates(z_phi, precise):
-            p_sub += norm(loc=phases_, scale=widths_).pdf(shifted_z_phi)
-
-        logp_sub = np.log(p_sub)
-        logp_eps = np.log(norm(loc=0.0, scale=self._epsilon).pdf(z_eps))
+        phases_, widths_ = self._parse_parameters(z_phi.shape[0], parameters, dtype=z_phi.dtype)
+
+        # Gaussian densities evaluated inline on all equivalent coordinates at once, scipy's frozen distributions are too slow here
+        if _mixture_logpdf_kernel is not None:
+            logp_sub = np.empty(z_phi.shape, dtype=z_phi.dtype)
+            _mixture_logpdf_kernel(z_phi, phases_, widths_, logp_sub)
+        else:
+            # The variant buffer is overwritten in place to avoid further (variants, n, latent_dim) temporaries
+            shifts = self._generate_equivalent_coordinates(z_phi, precise)  # (variants, n, latent_dim)
+            inv_w = 1.0 / widths_
+            shifts -= phases_[np.newaxis, :, :]
+            shifts *= inv_w[np.newaxis, :, :]
+            np.square(shifts, out=shifts)
+            shifts *= -0.5
+            np.exp(shifts, out=shifts)
+            logp_sub = np.log(np.sum(shifts, axis=0) * inv_w * _NORM)
+        logp_eps = -0.5 * (z_eps * self._inv_eps) ** 2 + self._log_eps_norm
 
         log_det = self._latent_dim * np.abs(r)
-        log_det += np.sum(np.arange(self._latent_dim - 1, -1, -1)[np.newaxis, :] * np.log(np.abs(np.sin(z_phi))), axis=1)
+        log_det += np.log(np.sin(z_phi[:, :-1])) @ self._exponents  # In float64 arctan2 keeps polar angles in [0, pi], so their sines are never negative
 
-        logp = np.concatenate((logp_sub, logp_eps), axis=1)
-        logp = np.sum(logp, axis=1) + log_det
+        logp = np.sum(logp_sub, axis=1) + np.sum(logp_eps, axis=1) + log_det
 
         return logp
 
     def _generate_equivalent_coordinates(self, z_phi, precise):
-        # Restrict z to canonical range: [0, pi) for polar angles, and [0., 2pi) for azimuthal angle
-        z_phi = z_phi % (2.0 * np.pi)
-        z_phi[:, :-1] = np.where(z_phi[:, :-1] > np.pi, 2.0 * np.pi - z_phi[:, :-1], z_phi[:, :-1])
+        # All variants stacked into one array, the first one being the canonical coordinates
+        n_variants = 2 * (self._latent_dim - 1) + 3
+        shifts = np.empty((n_variants,) + z_phi.shape, dtype=z_phi.dtype)
 
-        # Yield this one
-        yield z_phi
+        # Restrict z to canonical range: [0, pi) for polar angles, and [0., 2pi) for azimuthal angle, computed in place in the first variant
+        z_phi = np.remainder(z_phi, self._two_pi, out=shifts[0])
+        polar = z_phi[:, :-1]
+        np.subtract(self._two_pi, polar, out=polar, where=polar > np.pi)
+        shifts[1:] = z_phi[np.newaxis, :, :]
 
         # Variations of polar angles
         for dim in range(self._latent_dim - 1):
-            z = np.copy(z_phi)
-            z[:, dim] = -z_phi[:, dim]
-            yield z
-
-            z = np.copy(z_phi)
-            z[:, dim] = 2.0 * np.pi - z_phi[:, dim]
-            yield z
+            shifts[1 + 2 * dim, :, dim] = -z_phi[:, dim]
+            shifts[2 + 2 * dim, :, dim] = self._two_pi - z_phi[:, dim]
 
         # Variations of aximuthal angle
-        z = np.copy(z_phi)
-        z[:, -1] = -2.0 * np.pi + z_phi[:, -1]
-        yield z
+        shifts[-2, :, -1] = z_phi[:, -1] - self._two_pi
+        shifts[-1, :, -1] = z_phi[:, -1] + self._two_pi
 
-        z = np.copy(z_phi)
-        z[:, -1] = 2.0 * np.pi + z_phi[:, -1]
-        yield z
+        return shifts
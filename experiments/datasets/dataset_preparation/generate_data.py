@@ -36,6 +36,7 @@ def parse_args():
     parser.add_argument("--paramscan", type=int, default=0, help="Number of additional test samples for parameter tuning")
     parser.add_argument("--test", type=int, default=10000, help="Number of test samples")
     parser.add_argument("--ood", type=int, default=0, help="Number of OOD samples")
+    parser.add_argument("--chunksize", type=int, default=100000, help="Number of training samples generated at once and streamed to disk")
 
     parser.add_argument("--dir", type=str, default="/scratch/jb6504/manifold-flow", help="Base directory of repo")
     parser.add_argument("--debug", action="store_true", help="Debug mode (more log output, additional callbacks)")
@@ -56,17 +57,25 @@ if __name__ == "__main__":
     conditional = simulator.parameter_dim() is not None
 
     parameters_train = simulator.sample_from_prior(args.train) if conditional else None
+    default_parameters = np.asarray(simulator.default_parameters()).reshape((1, -1)) if conditional else None
 
     # Sample
     if args.train > 0:
         logger.info("Generating %s training samples at parameters %s", args.train, parameters_train)
-        x_train = simulator.sample(args.train, parameters=parameters_train)
-        np.save(create_filename("sample", "x_train", args), x_train)
+        x_train = None
+        for start in range(0, args.train, args.chunksize):
+            end = min(start + args.chunksize, args.train)
+            x_chunk = simulator.sample(end - start, parameters=parameters_train[start:end] if conditional else None)
+            if x_train is None:  # Keep whatever precision the simulator samples in
+                x_train = np.lib.format.open_memmap(create_filename("sample", "x_train", args), mode="w+", dtype=x_chunk.dtype, shape=(args.train,) + x_chunk.shape[1:])
+            x_train[start:end] = x_chunk
+        x_train.flush()
+        del x_train
         if conditional:
             np.save(create_filename("sample", "theta_train", args), parameters_train)
 
     if args.paramscan > 0:
-        parameters_val = np.array([simulator.default_parameters() for _ in range(args.paramscan)]).reshape((args.paramscan, -1)) if conditional else None
+        parameters_val = np.broadcast_to(default_parameters, (args.paramscan, default_parameters.shape[1])) if conditional else None
         logger.info("Generating %s param-scan samples at parameters %s", args.paramscan, parameters_val)
         x_val = simulator.sample(args.paramscan, parameters=parameters_val)
         np.save(create_filename("sample", "x_paramscan", args), x_val)
@@ -74,7 +83,7 @@ if __name__ == "__main__":
             np.save(create_filename("sample", "theta_paramscan", args), parameters_val)
 
     if args.test > 0:
-        parameters_test = np.array([simulator.default_parameters() for _ in range(args.test)]).reshape((args.test, -1)) if conditional else None
+        parameters_test = np.broadcast_to(default_parameters, (args.test, default_parameters.shape[1])) if conditional else None
         logger.info("Generating %s test samples at parameters %s", args.test, parameters_test)
         x_test = simulator.sample(args.test, parameters=parameters_test)
         np.save(create_filename("sample", "x_test", args), x_test)
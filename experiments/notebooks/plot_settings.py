@@ -19,7 +19,7 @@ CMAP_R = cm.plasma_r
 # CMAP = palettable.scientific.sequential.LaJolla_20_r.mpl_colormap
 
 # Colors
-COLORS = [CMAP(i/4.) for i in range(5)]
+COLORS = CMAP(np.linspace(0., 1., 5))  # (5, 4) array of RGBA colors
 # COLORS = palettable.scientific.sequential.Batlow_6.mpl_colors
 # COLORS = palettable.scientific.sequential.Tokyo_5.mpl_colors
 
@@ -215,18 +215,11 @@ def add_transparency(color, alpha):
     if isinstance(color, str):
         color2 = np.array(matplotlib.colors.to_rgba(color))
     else:
-        color2 = np.copy(np.array(color))
+        color2 = np.array(color, dtype=float)
 
-    if len(color2.shape) == 1:
-        if color2.shape[0] == 4:
-            color2[3] = alpha
-            return color2
-        elif color2.shape[0] == 3:
-            return np.hstack((color2, [alpha]))
+    # Works for single colors (shape (3,) or (4,)) as well as arrays of colors (shape (n, 3) or (n, 4))
+    if color2.shape[-1] == 3:
+        return np.concatenate((color2, np.full(color2.shape[:-1] + (1,), alpha)), axis=-1)
 
-    else:
-        if color2.shape[1] == 4:
-            color2[:, 3] = alpha
-            return color2
-        elif color2.shape[1] == 3:
-            return np.hstack((color2, alpha * np.ones((color2.shape[0], 1))))
+    color2[..., 3] = alpha
+    return color2